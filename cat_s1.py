@@ -77,7 +77,9 @@ if __name__ == '__main__':
         argslist.append( (images_by_orbit[ab_orbit], eofs[ab_orbit], ll_fname, log_fname, temp_workdir, args.unzipped) )
 
     # run GMTSAR function 'create_frame_tops.csh' in parallel
-    multiprocessing.set_start_method("spawn")
-    with multiprocessing.get_context("spawn").Pool(processes=args.nproc) as pool:
+    # forkserver: as safe as spawn, but s1_frame_func is imported once by the server, not per worker
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload(['s1_frame_func'])
+    with ctx.Pool(processes=args.nproc) as pool:
         pool.starmap(s1_frame_func.create_frame_tops_parallel, argslist, chunksize=1)
         
@@ -48,8 +48,10 @@ if __name__ == '__main__':
         argslist.append((sat_ab,start,end,[args.orbit_dir],download_missing,skip_notfound,args.precise,print_results))
 
     # for each identified orbit, look for the file, and download if necessary
-    multiprocessing.set_start_method("spawn")
-    with multiprocessing.get_context("spawn").Pool(processes=args.nproc) as pool:
+    # workers are forked from a server process that has already imported s1_orbit_func
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload(['s1_orbit_func'])
+    with ctx.Pool(processes=args.nproc) as pool:
         results = pool.starmap(s1_orbit_func.get_latest_orbit_file, argslist, chunksize=1)
 
     print('\nDone getting orbits.\n')
@@ -11,18 +11,19 @@ Modified Oct 2019 to enable multiple file types (e.g. csv,json,kml)
 Modified July 2021, minor fixes
 Modified April 2023, change multiprocessing start method to spawn to avoid race conditions
 Modified July 2024, download through url
+Modified October 2026, run parallel downloads in a thread pool instead of spawned processes
 
 @author: Eric Lindsey, University of New Mexico
 """
 
-import configparser, argparse, requests, csv, subprocess, os, multiprocessing, time, sys, zipfile, requests
-import urllib.request, shutil, uuid
-from urllib.error import HTTPError, URLError
-import PIL
-from PIL import Image
-import numpy as np
-import glob
-import sqlite3
+import configparser, argparse, requests, csv, os, time, sys, zipfile
+import shutil, uuid, threading, hashlib, logging, queue
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlencode, quote
+from xml.etree import ElementTree
 
 # optional use urllib instead of wget
 # from urllib.request import urlopen
@@ -35,9 +36,74 @@ aws_baseurl = (
     "http://sentinel1-slc-seasia-pds.s3-website-ap-southeast-1.amazonaws.com/datasets/slc/v1.1/"
 )
 
+# progress messages from the download threads; __main__ routes them through a single listener
+logger = logging.getLogger("sentinel_query_download")
+
+# size of the blocks streamed from the network to disk during downloads. Kept large so
+# each granule costs few write() calls; blocking writes need a bigger buffer than async I/O
+# to keep a fast disk busy.
+download_chunk_size = 4 << 20
+
+# zip members up to this size are decompressed into memory and written in one call; larger
+# ones are streamed to disk in blocks of this size. Bounds extraction memory per thread.
+extract_chunk_size = 1 << 20
+
+# ASF downloads redirect through the NASA Earthdata login host before landing on the file
+earthdata_host = "urs.earthdata.nasa.gov"
+
+
+class EarthdataSession(requests.Session):
+    """
+    requests.Session that keeps the Authorization header when redirected to or from the
+    Earthdata login host, so a single GET can follow the whole ASF redirect chain.
+    (requests otherwise strips auth on every redirect to a different host.)
+    """
+
+    def rebuild_auth(self, prepared_request, response):
+        if "Authorization" in prepared_request.headers:
+            original_host = requests.utils.urlparse(response.request.url).hostname
+            redirect_host = requests.utils.urlparse(prepared_request.url).hostname
+            if (
+                original_host != redirect_host
+                and redirect_host != earthdata_host
+                and original_host != earthdata_host
+            ):
+                del prepared_request.headers["Authorization"]
+
+
+def make_session():
+    """
+    Create a session with keep-alive connection pooling and a small retry policy, so
+    connections (and their TLS handshakes) are reused between granules.
+    """
+    session = EarthdataSession()
+    adapter = HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.3))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# requests.Session is not guaranteed to be thread-safe, so each download thread keeps its own.
+# All of them are also listed here, so close_sessions can release them when the downloads end.
+_thread_local = threading.local()
+_sessions = []
+
 
-def downloadGranule(row, args_dict, GUID_dir):
-    orig_dir = os.getcwd()
+def get_session():
+    # the calling thread's persistent session, created on its first download
+    if not hasattr(_thread_local, "session"):
+        _thread_local.session = make_session()
+        _sessions.append(_thread_local.session)
+    return _thread_local.session
+
+
+def close_sessions():
+    # close every download thread's session and its pooled sockets; call after the pool shuts down
+    while _sessions:
+        _sessions.pop().close()
+
+
+def downloadGranule(row, args_dict, extract_workers=None):
     download_site = row["Download Site"]
     frame_dir = "P" + row["Path Number"].zfill(3) + "/F" + row["Frame Number"].zfill(4)
 
@@ -46,61 +112,44 @@ def downloadGranule(row, args_dict, GUID_dir):
     sub_dir = args_dict["start"] + "/" + args_dict["end"]
 
     download_dir = os.path.join(satellite_dir, sub_dir)
-    # Setting up the directory structure:
-    flag = os.path.exists(satellite_dir)
-
-    if not flag:
-        os.makedirs(satellite_dir, exist_ok=True)
-        print("Existing parent dir: ", satellite_dir)
-    # elif not flag:
-    #     os.makedirs(satellite_dir, exist_ok=True)
-    #     os.makedirs(download_dir, exist_ok=True)
-    #     print("Had to create parent dir: ", satellite_dir)
-
-    print("Downloading granule ", row["Granule Name"], "to directory", frame_dir)
+    # Setting up the directory structure (exist_ok makes a separate exists() check redundant):
+    os.makedirs(satellite_dir, exist_ok=True)
+
+    logger.info("Downloading granule %s to directory %s", row["Granule Name"], frame_dir)
     # create frame directory
 
     status = 0
     if download_site == "AWS" or download_site == "both":
-        print("Try AWS download first.")
-        # create url for AWS download, based on the granule name
-        row_date = row["Acquisition Date"]
-        row_year = row_date[0:4]
-        row_month = row_date[5:7]
-        row_day = row_date[8:10]
-        datefolder = row_year + "/" + row_month + "/" + row_day + "/"
-        aws_url = (
-            aws_baseurl + datefolder + row["Granule Name"] + "/" + row["Granule Name"] + ".zip"
-        )
+        logger.info("Try AWS download of %s first.", row["Granule Name"])
+        # url for AWS download, built from the granule name in enrich_rows
+        aws_url = row["aws_url"]
         # run the download command
         status = 0
         # DEBUGGING COMMENTED OUT
         # downloadGranule_wget(aws_url)
         if status != 0:
             if download_site == "AWS":
-                print("AWS download failed. Granule not downloaded.")
+                logger.error("AWS download failed. Granule %s not downloaded.", row["Granule Name"])
             else:
-                print("AWS download failed. Trying ASF download instead.")
+                logger.warning(
+                    "AWS download of %s failed. Trying ASF download instead.", row["Granule Name"]
+                )
     if (status != 0 and download_site == "both") or download_site == "ASF":
         asf_url = row["asf_wget_str"] + " " + row["URL"]
         # run the download command
         # status = downloadGranule_wget(asf_url) DEBUGGING COMMENTED OUT
 
-        options = row["asf_wget_str"].split()
-        for option in options:
-            if option.startswith('--http-user='):
-                asf_user = option.split('=')[1]
-            elif option.startswith('--http-password='):
-                asf_pass = option.split('=')[1]
-
-        downloadGranule_url(row["URL"], asf_user, asf_pass)
+        # absolute path, so nothing depends on the (process-wide) working directory. Named after
+        # the URL's file name (as its checksum is keyed), since products of one granule share a name
+        zip_file = os.path.abspath(os.path.join(satellite_dir, row["URL"].split("/")[-1]))
+        status = downloadGranule_url(
+            row["URL"], zip_file, row["asf_user"], row["asf_pass"], row["md5sum"]
+        )
 
         if status != 0:
-            print("ASF download failed. Granule not downloaded.")
+            logger.error("ASF download failed. Granule %s not downloaded.", row["Granule Name"])
 
         if status == 0:
-            zip_file = row["Granule Name"] + ".zip"
-            
             #Below is to make directory structure of Satellite/Acquisition Date/metadata
             #renamed_directory = row["Acquisition Date"][:10]
             #destination_dir = os.path.join(satellite_dir, renamed_directory)
@@ -109,23 +158,16 @@ def downloadGranule(row, args_dict, GUID_dir):
             # satellite_dir = config.get("api_search", "dataset")
             # GUID_dir = os.path.join(satellite_dir, str(uuid.uuid4()))
 
-            #Extract all contents into the GUID_dir
-            with zipfile.ZipFile(zip_file, "r") as zip_ref:
-                zip_ref.extractall(GUID_dir)
-
-            extracted_dirs = [name for name in os.listdir(GUID_dir) if os.path.isdir(os.path.join(GUID_dir, name))]
-            dir_path = os.path.join(GUID_dir, extracted_dirs[0])
-            
-            if os.path.exists(dir_path) and os.path.isdir(dir_path):
-                for item in os.listdir(dir_path):
-                    shutil.move(os.path.join(dir_path, item), GUID_dir)
-                
-                os.rmdir(dir_path)
+            #Extract the contents of the .SAFE folder directly into this granule's GUID_dir
+            extract_zip(
+                zip_file,
+                row["GUID_dir"],
+                root=row["Granule Name"] + ".SAFE",
+                max_workers=extract_workers,
+            )
 
             os.remove(zip_file)
 
-    os.chdir(orig_dir)
-
 
 ## urllib not currently used. Test for speed?
 # def downloadGranule_urllib(url):
@@ -136,28 +178,211 @@ def downloadGranule(row, args_dict, GUID_dir):
 #            shutil.copyfileobj(response, ofile)
 #    return 0
 
-def downloadGranule_url(url, username, password):
-    print("URL: ", url," USER: ", username, " PASS :", password)
-    with requests.Session() as s:
-        s.auth = (username, password)
-        # Get the redirection URL: Notice the use of requests and not the session
-        r1 = requests.get(url) 
-        r = s.get(r1.url, allow_redirects=True)
-        # Define the filename
-        filename = url.split("/")[-1]
-
-        if r.status_code == 200:
-            with open(filename, "wb") as f:
-                f.write(r.content)
-            print(f"Downloaded '{filename}' successfully!")
-
-            # Verify if the file exists and has content
-            if os.path.isfile(filename) and os.path.getsize(filename) > 0:
-                print(f"File '{filename}' exists and is not empty.")
+def hash_file(filename, hasher):
+    # feed the bytes already on disk into hasher, e.g. the part of a resumed download
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(download_chunk_size), b""):
+            hasher.update(chunk)
+
+
+def content_range_total(response):
+    # total size N from a 'Content-Range: bytes */N' (or 'bytes a-b/N') header, None if unknown
+    total = response.headers.get("Content-Range", "").rpartition("/")[2].strip()
+    return int(total) if total.isdigit() else None
+
+
+def downloadGranule_url(url, filename, username, password, checksum=None):
+    logger.info("URL: %s USER: %s", url, username)
+    # if ASF gave us a checksum, hash the data as it streams past rather than re-reading the file
+    hasher = hashlib.md5(usedforsecurity=False) if checksum else None
+    # resume a partial download left by a previous run, rather than fetching it all again
+    pos = os.path.getsize(filename) if os.path.isfile(filename) else 0
+    headers = {"Range": "bytes=%d-" % pos} if pos > 0 else {}
+    stale = False
+    # the thread's session follows the Earthdata redirect itself, keeping auth along the way
+    with get_session().get(
+        url, auth=(username, password), headers=headers, allow_redirects=True, stream=True
+    ) as r:
+        if pos > 0 and r.status_code == 416 and content_range_total(r) != pos:
+            # the range is unsatisfiable because the local file is not a prefix of the remote
+            # one (e.g. a stale or corrupt leftover that is too long): fetch it again from scratch
+            stale = True
+        elif pos > 0 and r.status_code == 416:
+            # nothing left past pos, and the server's size matches: the file was already complete
+            logger.info("File '%s' already downloaded.", filename)
+            if hasher is not None:
+                hash_file(filename, hasher)
+        elif r.status_code not in (200, 206):
+            logger.error("Failed to download '%s': HTTP %s", filename, r.status_code)
+            return 1
+        else:
+            # 206: server sent the rest of the file, so append. 200: full file, so start over.
+            if r.status_code == 206:
+                logger.info("Resuming '%s' from byte %d.", filename, pos)
+                mode = "ab"
+                if hasher is not None:
+                    hash_file(filename, hasher)
             else:
-                print(f"File '{filename}' is empty or does not exist.")
+                mode = "wb"
+            # stream to disk in chunks rather than holding the whole (multi-GB) granule in memory
+            with open(filename, mode) as f:
+                for chunk in r.iter_content(chunk_size=download_chunk_size):
+                    f.write(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+            logger.info("Downloaded '%s' successfully!", filename)
+
+    if stale:
+        logger.warning(
+            "Existing file '%s' (%d bytes) does not match the remote file, downloading it again.",
+            filename,
+            pos,
+        )
+        os.remove(filename)
+        return downloadGranule_url(url, filename, username, password, checksum)
+
+    # Verify if the file exists and has content
+    if not (os.path.isfile(filename) and os.path.getsize(filename) > 0):
+        logger.error("File '%s' is empty or does not exist.", filename)
+        return 1
+    logger.info("File '%s' exists and is not empty.", filename)
+
+    # Verify the contents against the checksum; a corrupt file is removed so the next run refetches it
+    if hasher is not None:
+        if hasher.hexdigest() != checksum.lower():
+            logger.error("Checksum mismatch for '%s', removing it.", filename)
+            os.remove(filename)
+            return 1
+        logger.info("File '%s' matches its MD5 checksum.", filename)
+    else:
+        logger.warning("No checksum for '%s'; only checked that it is not empty.", filename)
+    return 0
+
+
+def zip_member_path(dest_dir, name):
+    # same sanitizing as zipfile: drop empty, '.' and '..' components so members stay in dest_dir
+    parts = [part for part in name.split("/") if part not in ("", ".", "..")]
+    return os.path.join(dest_dir, *parts)
+
+
+def write_file(path, data):
+    # write bytes straight through os.open/os.write/os.close, skipping the extra fstat and
+    # isatty calls that open() makes to set up buffering a small file does not need
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
+
+
+def extract_zip(zip_file, dest_dir, root=None, max_workers=None):
+    """
+    Extract all members of zip_file into dest_dir, decompressing the entries in parallel on
+    max_workers threads (default: one per CPU).
+    Each thread reads through its own ZipFile handle, since one handle has a single file position.
+    If root is given (e.g. the granule's .SAFE folder), members under it are written directly
+    into dest_dir without that leading folder, so nothing has to be moved afterwards.
+    """
+    with zipfile.ZipFile(zip_file, "r") as zip_ref:
+        members = zip_ref.infolist()
+
+    # create the directory tree up front so the extraction threads never race on makedirs
+    dirs = set()
+    files = []
+    for info in members:
+        name = info.filename
+        if root is not None and name.startswith(root + "/"):
+            name = name[len(root) + 1 :]
+        target = zip_member_path(dest_dir, name)
+        if info.is_dir():
+            dirs.add(target)
+        else:
+            dirs.add(os.path.dirname(target))
+            files.append((info, target))
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+
+    local = threading.local()
+    handles = []
+
+    def extract_member(item):
+        info, target = item
+        if not hasattr(local, "zip_ref"):
+            local.zip_ref = zipfile.ZipFile(zip_file, "r")
+            handles.append(local.zip_ref)
+        if info.file_size <= extract_chunk_size:
+            # small members (like the many annotation XMLs): decompress in one go and write raw
+            write_file(target, local.zip_ref.read(info))
         else:
-            print(f"Failed to download: HTTP {r.status_code}")
+            with local.zip_ref.open(info) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst, extract_chunk_size)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+            list(executor.map(extract_member, files))
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+def query_checksums(arg_list):
+    """
+    ASF's csv output has no checksums, so repeat the same search with metalink output, which
+    lists an md5 hash for each file. Returns a dict of file name (e.g. granule.zip) -> md5.
+    """
+    metalink_args = [item for item in arg_list if item[0] != "output"] + [("output", "metalink")]
+    checksums = {}
+    with requests.post(asf_baseurl + urlencode(metalink_args, quote_via=quote), stream=True) as r:
+        r.raise_for_status()
+        # parse the reply as it streams in, keeping only the hashes rather than the whole document
+        r.raw.decode_content = True
+        for _, elem in ElementTree.iterparse(r.raw):
+            if elem.tag.rpartition("}")[2] != "file":
+                continue
+            md5 = elem.find("{*}verification/{*}hash[@type='md5']")
+            if md5 is not None and md5.text:
+                checksums[elem.get("name")] = md5.text.strip()
+            elem.clear()
+    return checksums
+
+
+def read_query_rows(query_log):
+    # iterate over the rows of a saved ASF csv query result, one at a time
+    with open(query_log, newline="", encoding="utf-8") as f:
+        yield from csv.DictReader(f)
+
+
+def enrich_rows(rows, download_site, asf_wget_str, asf_user, asf_pass, satellite_dir, checksums):
+    # add some extra info to each csv row for download purposes, one row at a time.
+    # everything the download threads need is worked out here, once, in the main thread
+    for row in rows:
+        # md5 of the granule's zip from the metalink query, keyed by file name (None if missing)
+        row["md5sum"] = checksums.get(row["URL"].split("/")[-1])
+        # each granule gets its own Satellite/GUID directory for its SAFE contents
+        row["GUID_dir"] = os.path.abspath(os.path.join(satellite_dir, str(uuid.uuid4())))
+        row["Download Site"] = download_site
+        row["asf_wget_str"] = asf_wget_str
+        row["asf_user"] = asf_user
+        row["asf_pass"] = asf_pass
+        # create url for AWS download, based on the granule name and acquisition date
+        row_date = row["Acquisition Date"]
+        granule = row["Granule Name"]
+        row["aws_url"] = aws_baseurl + "%s/%s/%s/%s/%s.zip" % (
+            row_date[0:4], row_date[5:7], row_date[8:10], granule, granule
+        )
+        yield row
+
+
+def report_finished(pending, done):
+    # log the outcome of each finished download and drop it from the pending futures
+    for future in done:
+        granule = pending.pop(future)
+        try:
+            future.result()
+        except Exception as e:
+            logger.error("Granule %s failed: %s", granule, e)
 
 
 def chop_array(array, chip_size):
@@ -224,7 +449,6 @@ if __name__ == "__main__":
     output_format = config.get("api_search", "output", fallback="csv")
     
     satellite_dir = config.get("api_search", "dataset")
-    GUID_dir = os.path.join(satellite_dir, str(uuid.uuid4()))
 
 
     # Update config only if arguments are provided
@@ -273,8 +497,6 @@ if __name__ == "__main__":
     # we parse the config options directly into a query... this may be too naive
     arg_list = config.items("api_search")
 
-    config.read('sentinel_query.config')
-
     command_line_args = {}
 
     for arg in sys.argv[1:]:
@@ -295,18 +517,26 @@ if __name__ == "__main__":
             if key not in command_line_args:
                 command_line_args[key] = value
 
-    command_line_url = "&".join("%s=%s" % (key, value) for key, value in command_line_args.items())
-
-    # join as a single argument string
-    arg_str = "&".join("%s=%s" % (item[0], item[1]) for item in arg_list)
+    # join as a single, properly percent-encoded argument string (spaces, parens, '+', etc.)
+    arg_str = urlencode(arg_list, quote_via=quote)
     # form into a query
-
-    new_arg_str = arg_str.replace("+", "%2B")
-
-    argurl = asf_baseurl + new_arg_str
-    commandurl = asf_baseurl + command_line_url
-    print("COMMANDLINE URL: ", commandurl + "\n")
-    print(argurl)
+    argurl = asf_baseurl + arg_str
+    if args.verbose:
+        # the command-line URL is never queried, only printed for reference. The raw argv
+        # parsing above stores '--password secret' as two keys, so redact by the secret itself
+        # (from argparse and the config) as well as by the credential option names
+        secrets = {args.password, config.get("asf_download", "http-password", fallback="")}
+        secrets.discard(None)
+        secrets.discard("")
+        shown_args = {
+            key: value
+            for key, value in command_line_args.items()
+            if key not in ("password", "http-password")
+            and key not in secrets
+            and str(value) not in secrets
+        }
+        commandurl = asf_baseurl + urlencode(shown_args, quote_via=quote)
+        print("COMMANDLINE URL: ", commandurl + "\n")
     # example query:
     # argurl="https://api.daac.asf.alaska.edu/services/search/param?platform=R1\&absoluteOrbit=25234\&output=CSV"
 
@@ -316,27 +546,27 @@ if __name__ == "__main__":
 
     start_time = time.time()
 
-    r = requests.post(argurl)
-    # parse rows if csv, else we just operate on the 'r' object
-    if output_format == "csv":
-        reader = csv.DictReader(r.text.splitlines())
-        rows = list(reader)
-
-
+    r = requests.post(argurl, stream=True)
+    r.raise_for_status()
 
-    # save the results to a file
+    # save the results to a file, streaming the response instead of holding it all as r.text
     logtime = time.strftime("%Y_%m_%d-%H_%M_%S")
     query_log = "asf_query_%s.%s" % (logtime, output_format)
-    with open(query_log, "w") as f:
-        print("Query result saved to asf_query_%s.%s" % (logtime, output_format))
-        f.write(r.text)
-        
+    with r, open(query_log, "wb") as f:
+        for chunk in r.iter_content(chunk_size=download_chunk_size):
+            f.write(chunk)
+    print("Query result saved to asf_query_%s.%s" % (logtime, output_format))
+
+    # parse rows if csv (read back lazily from the saved file), else we just print the file
+    if output_format == "csv":
+        rows = read_query_rows(query_log)
 
     # print the results to the screen
     if args.verbose:
         if output_format == "csv":
-            # print the results in a nice format
-            numscenes = len(rows)
+            # print the results in a nice format. Count with a separate pass over the saved
+            # file, so the rows used for downloading are never held in a list
+            numscenes = sum(1 for _ in read_query_rows(query_log))
             plural_s = "s" if numscenes > 1 else ""
             if numscenes > 0:
                 print("Found %s scene%s." % (numscenes, plural_s))
@@ -348,7 +578,8 @@ if __name__ == "__main__":
                 #         % (row["Granule Name"], row["Path Number"], row["Frame Number"])
                 #     )
         else:
-            print(r.text)
+            with open(query_log) as f:
+                print(f.read())
 
     # If a download is requested:
     # parse result into a list of granules, figure out the correct path, and download each one.
@@ -374,24 +605,61 @@ if __name__ == "__main__":
                 raise ValueError("ASF username or password missing in config file.")
             asf_wget_options = config.items("asf_download")
             asf_wget_str = " ".join("--%s=%s" % (item[0], item[1]) for item in asf_wget_options)
-
         else:
             asf_wget_str = ""
-        downloadList = []
-        for row in rows:
-            downloadDict = row
-            # add some extra info to the csv row for download purposes
-            downloadDict["Download Site"] = download_site
-            downloadDict["asf_wget_str"] = asf_wget_str
-            downloadList.append(downloadDict)
-        # map list to multiprocessing pool
-        
-        multiprocessing.set_start_method("spawn")
-        with multiprocessing.get_context("spawn").Pool(processes=nproc) as pool:
-            pool.starmap(
-                downloadGranule, [(row, command_line_args, GUID_dir) for row in downloadList], chunksize=1
-            )
-            # pool.map(downloadGranule, downloadList, chunksize=1)
+        # the csv results carry no checksums, so fetch them from a metalink query - but only when
+        # downloads go through ASF ('both' only falls back to ASF if AWS fails, which it
+        # currently never does)
+        checksums = {}
+        if download_site == "ASF":
+            try:
+                checksums = query_checksums(arg_list)
+            except (requests.RequestException, ElementTree.ParseError) as e:
+                print("Warning: could not get checksums from ASF (%s)." % e)
+                print("Downloads will only be checked for being non-empty.")
+        downloadList = enrich_rows(
+            rows,
+            download_site,
+            asf_wget_str,
+            config.get("asf_download", "http-user", fallback=""),
+            config.get("asf_download", "http-password", fallback=""),
+            satellite_dir,
+            checksums,
+        )
+        # the download threads only enqueue their log records; one listener thread writes
+        # them all to stderr, so the threads never contend for the stream or interleave lines
+        log_queue = queue.SimpleQueue()
+        logger.addHandler(QueueHandler(log_queue))
+        logger.setLevel(logging.INFO)
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(levelname)s %(threadName)s: %(message)s"))
+        listener = QueueListener(log_queue, handler)
+        # each download extracts its own zip in parallel; split the CPUs between the nproc
+        # downloads so threads (and open ZipFile handles) stay around cpu_count, not nproc x that
+        extract_workers = max(1, (os.cpu_count() or 1) // nproc)
+        listener.start()
+        # stop the listener even on an error or Ctrl-C, so records still queued get written
+        try:
+            # map list to a thread pool: the work is network/disk bound, so threads in one
+            # process give nproc concurrent downloads without spawning and pickling per granule
+            with ThreadPoolExecutor(max_workers=nproc, thread_name_prefix="download") as executor:
+                # keep at most 2*nproc granules submitted, topping up as downloads finish, so
+                # only a small window of rows and futures is alive; each is handled on completion
+                pending = {}
+                for row in downloadList:
+                    if len(pending) >= 2 * nproc:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        report_finished(pending, done)
+                    future = executor.submit(
+                        downloadGranule, row, command_line_args, extract_workers
+                    )
+                    pending[future] = row["Granule Name"]
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    report_finished(pending, done)
+        finally:
+            close_sessions()
+            listener.stop()
         print("\nDownload complete.\n")
         end_time = time.time()
         elapsed_time = end_time-start_time